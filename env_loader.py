@@ -2,6 +2,9 @@
 import os
 from pathlib import Path
 
+_HASH = ord("#")
+_QUOTES = "\"'"
+
 
 def load_env(env_path = ".env") -> dict[str, str]:
     """Load environment variables from a .env file.
@@ -15,31 +18,43 @@ def load_env(env_path = ".env") -> dict[str, str]:
     if not env_file.exists():
         return loaded
     
-    with open(env_file, "r") as f:
-        for line in f:
-            line = line.strip()
-            
-            # Skip empty lines and comments
-            if not line or line.startswith("#"):
-                continue
-            
-            # Parse KEY=VALUE
-            if "=" not in line:
-                continue
-            
-            key, _, value = line.partition("=")
-            key = key.strip()
-            value = value.strip()
-            
-            # Remove quotes if present
-            if (value.startswith('"') and value.endswith('"')) or \
-               (value.startswith("'") and value.endswith("'")):
-                value = value[1:-1]
-            
-            # Only set if not already in environment and value is not empty
-            if key and value and key not in os.environ:
-                os.environ[key] = value
-                loaded[key] = value
+    environ = os.environ
+    data = env_file.read_bytes()
+    # Universal newlines, as text-mode reading does: \r\n and a lone \r also end a line
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    size = len(data)
+    pos = 0
+    
+    while pos < size:
+        eol = data.find(b"\n", pos)
+        if eol == -1:
+            eol = size
+        line = data[pos:eol].strip()
+        pos = eol + 1
+        
+        # Skip empty lines and comments
+        if not line or line[0] == _HASH:
+            continue
+        
+        # Parse KEY=VALUE
+        eq = line.find(b"=")
+        if eq == -1:
+            continue
+        
+        # Decode before stripping so Unicode whitespace (e.g. U+00A0) is trimmed too
+        key = line[:eq].decode("utf-8").strip()
+        if key.startswith("#"):
+            continue  # Comment preceded by Unicode whitespace
+        value = line[eq + 1:].decode("utf-8").strip()
+        
+        # Remove quotes if present
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in _QUOTES:
+            value = value[1:-1]
+        
+        # Only set if not already in environment and value is not empty
+        if key and value and key not in environ:
+            environ[key] = loaded[key] = value
     
     return loaded
 
@@ -1,7 +1,9 @@
 """REST API server using Python standard library."""
 import json
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse
 from pathlib import Path
 
@@ -12,13 +14,76 @@ from env_loader import load_env, get_env
 SCRIPT_DIR = Path(__file__).parent.resolve()
 load_env(SCRIPT_DIR / ".env")
 
-from models import ChatRequest, ChatResponse
+from models import ChatResponse
 from llm_client import LLMClient
 
-# In-memory session storage
-sessions: dict[str, list[dict]] = {}
+# orjson is optional; fall back to the standard library json module
+try:
+    import orjson
+    
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+    def _json_dumps(data) -> bytes:
+        return json.dumps(data).encode()
+    
+    _json_loads = json.loads
+
+
+def _build_json_response(data: dict) -> bytes:
+    """Pre-serialize the fixed part of a JSON response: its static headers and body.
+    
+    The status line, Server and Date headers are added per request by _send_prebuilt.
+    """
+    body = _json_dumps(data)
+    head = (
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Access-Control-Allow-Origin: *\r\n"
+        "Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+        "Access-Control-Allow-Headers: Content-Type\r\n"
+        "\r\n"
+    )
+    return head.encode("latin-1") + body
+
+
+# Responses whose headers/body never change: GET 404s, and /api/status once the
+# client is known (None until run_server builds it)
+NOT_FOUND_RESPONSE = _build_json_response({"error": "Not found"})
+status_response: bytes | None = None
+
+# In-memory session storage (shared by handler threads, guarded by sessions_lock);
+# each history keeps only the last 10 exchanges
+SESSION_HISTORY_LIMIT = 20
+sessions: dict[str, deque[dict]] = {}
+sessions_lock = threading.Lock()
 llm_client: LLMClient = None
 
+# Canned answers for the example questions offered in the UI, keyed by the
+# normalized (stripped, lower-cased) message; served without calling the LLM
+FAQ: dict[str, tuple[str, str]] = {
+    "how many assets do i have?": (
+        "This query counts all of your assets, excluding disposed ones.",
+        "SELECT COUNT(*) AS AssetCount FROM Assets WHERE Status <> 'Disposed'",
+    ),
+    "how many assets by site?": (
+        "This query counts your non-disposed assets for each site.",
+        "SELECT s.SiteName, COUNT(*) AS AssetCount FROM Assets a "
+        "JOIN Sites s ON s.SiteId = a.SiteId WHERE a.Status <> 'Disposed' "
+        "GROUP BY s.SiteName ORDER BY AssetCount DESC",
+    ),
+    "how many open purchase orders?": (
+        "This query counts purchase orders that are still open.",
+        "SELECT COUNT(*) AS OpenPurchaseOrders FROM PurchaseOrders WHERE Status = 'Open'",
+    ),
+    "total value of assets per site?": (
+        "This query sums the cost of non-disposed assets for each site.",
+        "SELECT s.SiteName, SUM(a.Cost) AS TotalAssetValue FROM Assets a "
+        "JOIN Sites s ON s.SiteId = a.SiteId WHERE a.Status <> 'Disposed' "
+        "GROUP BY s.SiteName ORDER BY TotalAssetValue DESC",
+    ),
+}
+
 # Embedded HTML (always works regardless of file location)
 EMBEDDED_HTML = '''<!DOCTYPE html>
 <html lang="en">
@@ -99,6 +164,12 @@ EMBEDDED_HTML = '''<!DOCTYPE html>
         function addMessage(content, type, sql, meta) {
             const div = document.createElement('div');
             div.className = 'message ' + type;
+            chatBox.appendChild(div);
+            renderMessage(div, content, sql, meta);
+            return div;
+        }
+
+        function renderMessage(div, content, sql, meta) {
             let html = '<div class="bubble">' + escapeHtml(content) + '</div>';
             if (sql) {
                 html += '<div class="sql-block">' + escapeHtml(sql) + '</div>';
@@ -107,10 +178,30 @@ EMBEDDED_HTML = '''<!DOCTYPE html>
                 html += '<div class="meta">' + meta + '</div>';
             }
             div.innerHTML = html;
-            chatBox.appendChild(div);
             chatBox.scrollTop = chatBox.scrollHeight;
         }
 
+        async function readEvents(response, onEvent) {
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) break;
+                buffer += decoder.decode(value, { stream: true });
+                let end;
+                while ((end = buffer.indexOf('\\n\\n')) !== -1) {
+                    let event = 'message', data = '';
+                    for (const line of buffer.slice(0, end).split('\\n')) {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    }
+                    buffer = buffer.slice(end + 2);
+                    onEvent(event, JSON.parse(data));
+                }
+            }
+        }
+
         function escapeHtml(text) {
             const div = document.createElement('div');
             div.textContent = text;
@@ -132,18 +223,30 @@ EMBEDDED_HTML = '''<!DOCTYPE html>
             sendBtn.innerHTML = '<span class="loading"></span>';
 
             try {
-                const response = await fetch('/api/chat', {
+                const response = await fetch('/api/chat/stream', {
                     method: 'POST',
                     headers: { 'Content-Type': 'application/json' },
                     body: JSON.stringify({ session_id: sessionId, message: message })
                 });
-                const data = await response.json();
 
-                if (data.status === 'ok') {
-                    const meta = data.provider + ' | ' + data.model + ' | ' + data.latency_ms + 'ms | ' + data.token_usage.total_tokens + ' tokens';
-                    addMessage(data.natural_language_answer, 'assistant', data.sql_query, meta);
+                if (!response.ok) {
+                    const data = await response.json();
+                    addMessage('Error: ' + (data.error || 'Unknown error'), 'assistant', null, null);
                 } else {
-                    addMessage('Error: ' + (data.error_message || data.error || 'Unknown error'), 'assistant', null, null);
+                    // Show the answer text as it streams in, then the final answer, SQL and stats
+                    const div = addMessage('…', 'assistant', null, null);
+                    let answer = '';
+                    await readEvents(response, (event, data) => {
+                        if (event === 'delta') {
+                            answer += data.content;
+                            renderMessage(div, answer, null, null);
+                        } else if (event === 'done' && data.status === 'ok') {
+                            const meta = data.provider + ' | ' + data.model + ' | ' + data.latency_ms + 'ms | ' + data.token_usage.total_tokens + ' tokens';
+                            renderMessage(div, data.natural_language_answer, data.sql_query, meta);
+                        } else if (event === 'done') {
+                            renderMessage(div, 'Error: ' + (data.error_message || 'Unknown error'), null, null);
+                        }
+                    });
                 }
             } catch (e) {
                 addMessage('Network error: ' + e.message, 'assistant', null, null);
@@ -156,105 +259,264 @@ EMBEDDED_HTML = '''<!DOCTYPE html>
 </body>
 </html>'''
 
+# Encoded once; the page is served as-is on every GET /
+EMBEDDED_HTML_BYTES = EMBEDDED_HTML.encode("utf-8")
+EMBEDDED_HTML_LEN = str(len(EMBEDDED_HTML_BYTES))
+
+
+def _open_session(session_id: str) -> tuple[deque, list[dict]]:
+    """Get or create a session's history, plus a copy for the LLM call to use outside the lock."""
+    with sessions_lock:
+        history = sessions.get(session_id)
+        if history is None:
+            history = sessions[session_id] = deque(maxlen=SESSION_HISTORY_LIMIT)
+        
+        return history, list(history)
+
+
+def _record_turn(history: deque, message: str, result: dict):
+    """Append a successful exchange to the session history.
+    
+    The assistant turn is a short summary: the answer plus its SQL, so follow-ups
+    ("now group that by vendor") can build on the previous query. Only string
+    fields are stored (the ChatResponse field types), so a malformed result can
+    never poison later turns.
+    """
+    answer = result["natural_language_answer"]
+    sql_query = result["sql_query"]
+    if result["status"] == "ok" and isinstance(answer, str) and isinstance(sql_query, str):
+        content = f"{answer}\nSQL: {sql_query}" if sql_query else answer
+        with sessions_lock:
+            history.append({"role": "user", "content": message})
+            history.append({"role": "assistant", "content": content})
+
+
+def _faq_result(message: str) -> dict | None:
+    """Return the canned result for an FAQ question, or None."""
+    faq = FAQ.get(message.strip().lower())
+    if faq is None:
+        return None
+    answer, sql_query = faq
+    return {
+        "natural_language_answer": answer,
+        "sql_query": sql_query,
+        "token_usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "latency_ms": 0,
+        "provider": llm_client.provider,
+        "model": llm_client.model,
+        "status": "ok",
+    }
+
+
+def _chat_events(message: str, session_history: list[dict]):
+    """Yield (event, payload) pairs for a streamed chat turn, answering FAQs directly."""
+    result = _faq_result(message)
+    if result is not None:
+        yield "done", result
+    else:
+        yield from llm_client.chat_stream(
+            messages=[{"role": "user", "content": message}],
+            session_history=session_history,
+        )
+
 
 class RequestHandler(BaseHTTPRequestHandler):
     """HTTP request handler for the chat API."""
     
+    # Keep-alive: every response below sets Content-Length, and any response sent
+    # without reading the request body closes the connection instead
+    protocol_version = "HTTP/1.1"
+    # Drop idle keep-alive connections so they don't hold a server thread forever
+    timeout = 30
+    
     def _send_response(self, status: int, data: dict):
+        body = _json_dumps(data)
         self.send_response(status)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(body)
+    
+    def _send_prebuilt(self, status: int, response: bytes):
+        # send_response writes the status line, Server and Date, and logs the request
+        self.send_response(status)
+        self.flush_headers()
+        self.wfile.write(response)
     
-    def _send_html(self, content: str):
+    def _send_html(self):
         self.send_response(200)
         self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", EMBEDDED_HTML_LEN)
         self.end_headers()
-        self.wfile.write(content.encode("utf-8"))
+        self.wfile.write(EMBEDDED_HTML_BYTES)
     
     def do_OPTIONS(self):
         self.send_response(200)
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Content-Length", "0")
         self.end_headers()
     
     def do_GET(self):
         path = urlparse(self.path).path
         
         if path == "/" or path == "/index.html":
-            self._send_html(EMBEDDED_HTML)
+            self._send_html()
         elif path == "/api/status":
-            self._send_response(200, {
-                "status": "running",
-                "provider": llm_client.provider,
-                "model": llm_client.model,
-            })
+            if status_response is None:
+                self._send_response(200, {
+                    "status": "running",
+                    "provider": llm_client.provider,
+                    "model": llm_client.model,
+                })
+            else:
+                self._send_prebuilt(200, status_response)
         else:
-            self._send_response(404, {"error": "Not found"})
+            self._send_prebuilt(404, NOT_FOUND_RESPONSE)
     
     def do_POST(self):
         path = urlparse(self.path).path
         
         if path == "/api/chat":
             self._handle_chat()
+        elif path == "/api/chat/stream":
+            self._handle_chat_stream()
         else:
+            # The body is left unread, so the connection can't be reused
+            # (_send_response announces the close)
+            self.close_connection = True
             self._send_response(404, {"error": "Not found"})
     
-    def _handle_chat(self):
+    def _read_chat_request(self) -> tuple[str, str] | None:
+        """Read and validate a chat request body.
+        
+        Returns (session_id, message), or sends a 400 and returns None.
+        """
         try:
             content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length).decode()
-            data = json.loads(body)
-            
-            # Validate request
-            request = ChatRequest(**data)
-            
-            # Get or create session
-            if request.session_id not in sessions:
-                sessions[request.session_id] = []
-            
-            session_history = sessions[request.session_id]
+        except ValueError:
+            content_length = -1
+        if content_length < 0 or "Transfer-Encoding" in self.headers:
+            # Body length unknown (or chunked), so it can't be read or skipped reliably
+            self.close_connection = True
+            self._send_response(400, {"error": "A valid Content-Length is required"})
+            return None
+        body = self.rfile.read(content_length)
+        data = _json_loads(body)
+        
+        # Validate request (hand-checked against the models.ChatRequest fields)
+        if not isinstance(data, dict):
+            self._send_response(400, {"error": "Request body must be a JSON object"})
+            return None
+        session_id = data.get("session_id")
+        message = data.get("message")
+        context = data.get("context")
+        if not isinstance(session_id, str) or not isinstance(message, str):
+            self._send_response(400, {"error": "session_id and message must be strings"})
+            return None
+        if context is not None and not isinstance(context, dict):
+            self._send_response(400, {"error": "context must be an object"})
+            return None
+        if not message.strip():
+            self._send_response(400, {"error": "message must not be empty"})
+            return None
+        return session_id, message
+    
+    def _handle_chat(self):
+        try:
+            request = self._read_chat_request()
+            if request is None:
+                return
+            session_id, message = request
+            history, session_history = _open_session(session_id)
             
-            # Call LLM
-            result = llm_client.chat(
-                messages=[{"role": "user", "content": request.message}],
-                session_history=session_history,
-            )
+            result = _faq_result(message)
+            if result is None:
+                # Call LLM
+                result = llm_client.chat(
+                    messages=[{"role": "user", "content": message}],
+                    session_history=session_history,
+                )
             
-            # Update session history
-            if result["status"] == "ok":
-                sessions[request.session_id].append({"role": "user", "content": request.message})
-                sessions[request.session_id].append({
-                    "role": "assistant",
-                    "content": json.dumps({
-                        "answer": result["natural_language_answer"],
-                        "sql_query": result["sql_query"],
-                    })
-                })
-                # Keep only last 10 exchanges
-                sessions[request.session_id] = sessions[request.session_id][-20:]
+            _record_turn(history, message, result)
             
-            response = ChatResponse(**result)
-            self._send_response(200, response.model_dump())
+            # result already has the models.ChatResponse shape
+            assert ChatResponse.model_fields.keys() - result.keys() <= {"error_message"}, result
+            self._send_response(200, {**result, "error_message": result.get("error_message")})
             
         except json.JSONDecodeError:
             self._send_response(400, {"error": "Invalid JSON"})
         except Exception as e:
+            # The body may not have been fully read
+            self.close_connection = True
+            self._send_response(500, {"error": str(e)})
+    
+    def _handle_chat_stream(self):
+        """Stream the answer as Server-Sent Events.
+        
+        Sends "delta" events ({"content": ...}) as the model generates, then
+        one "done" event carrying the same body as /api/chat.
+        """
+        try:
+            request = self._read_chat_request()
+            if request is None:
+                return
+            session_id, message = request
+            history, session_history = _open_session(session_id)
+        except json.JSONDecodeError:
+            self._send_response(400, {"error": "Invalid JSON"})
+            return
+        except Exception as e:
+            # The body may not have been fully read
+            self.close_connection = True
             self._send_response(500, {"error": str(e)})
+            return
+        
+        # No Content-Length for an event stream, so close the connection when done
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        
+        events = _chat_events(message, session_history)
+        try:
+            for event, payload in events:
+                if event == "done":
+                    _record_turn(history, message, payload)
+                    payload = {**payload, "error_message": payload.get("error_message")}
+                else:
+                    payload = {"content": payload}
+                self.wfile.write(b"event: %s\ndata: %s\n\n" % (event.encode(), _json_dumps(payload)))
+                self.wfile.flush()
+        except ConnectionError:
+            pass  # Client went away; closing the generator ends the provider stream
+        finally:
+            events.close()
     
     def log_message(self, format, *args):
         print(f"[{self.log_date_time_string()}] {args[0]}")
 
 
 def run_server(host: str = "0.0.0.0", port: int = 8000):
-    global llm_client
+    global llm_client, status_response
     llm_client = LLMClient()
+    status_response = _build_json_response({
+        "status": "running",
+        "provider": llm_client.provider,
+        "model": llm_client.model,
+    })
     
-    server = HTTPServer((host, port), RequestHandler)
+    # One thread per connection so a slow LLM call doesn't block other clients
+    server = ThreadingHTTPServer((host, port), RequestHandler)
     print()
     print("=" * 56)
     print("  Inventory Chatbot Server")